@@ -1,11 +1,19 @@
+import asyncio
 import datetime
 import logging.config
 from environs import Env
 from seller import download_stock
 
+import orjson
 import requests
 
-from seller import divide, price_conversion
+from seller import (
+    SESSION,
+    compress_payload,
+    divide,
+    prices_conversion,
+    send_batches,
+)
 
 logger = logging.getLogger(__file__)
 
@@ -28,19 +36,16 @@ def get_product_list(page, campaign_id, access_token):
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
     headers = {
-        "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
     }
     payload = {
         "page_token": page,
         "limit": 200,
     }
     url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
+    response = SESSION.get(url, headers=headers, params=payload)
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object.get("result")
 
 
@@ -61,16 +66,16 @@ def update_stocks(stocks, campaign_id, access_token):
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
     headers = {
-        "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
+        "Content-Type": "application/json",
     }
     payload = {"skus": stocks}
     url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
+    body, body_headers = compress_payload(payload)
+    headers.update(body_headers)
+    response = SESSION.put(url, headers=headers, data=body)
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object
 
 
@@ -92,20 +97,45 @@ def update_price(prices, campaign_id, access_token):
     """
     endpoint_url = "https://api.partner.market.yandex.ru/"
     headers = {
-        "Content-Type": "application/json",
         "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
+        "Content-Type": "application/json",
     }
     payload = {"offers": prices}
     url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
+    body, body_headers = compress_payload(payload)
+    headers.update(body_headers)
+    response = SESSION.post(url, headers=headers, data=body)
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object
 
 
-def get_offer_ids(campaign_id, market_token):
+def get_offer_page(page, campaign_id, market_token):
+    """Получить артикулы одной страницы товаров
+
+    Из ответа сразу оставляем только артикулы, чтобы карточки товаров
+    не хранились дольше, чем нужно.
+
+    Args:
+        page (str): токен пагинации по продуктам
+        campaign_id (str): идентификатор кампании
+        market_token (str): токен продавца
+
+    Returns:
+        tuple: артикулы страницы и токен следующей страницы
+    Examples:
+        >>> get_offer_page("", campaign_id, market_token)
+        (["123", "456"], "eyJvcCI6Ij4iLCJrZXki")
+    """
+    some_prod = get_product_list(page, campaign_id, market_token)
+    page_ids = [
+        product["offer"]["shopSku"]
+        for product in some_prod["offerMappingEntries"]
+    ]
+    return page_ids, some_prod.get("paging").get("nextPageToken")
+
+
+async def get_offer_ids(campaign_id, market_token):
     """Получить список товаров
 
     Args:
@@ -115,22 +145,22 @@ def get_offer_ids(campaign_id, market_token):
     Returns:
         list: список товаров
     Examples:
-        >>> get_offer_ids(campaign_id, market_token)
+        >>> asyncio.run(get_offer_ids(campaign_id, market_token))
         [{"offer_id": "123", "stock": 100}, {"offer_id": "456", "stock": 0}]
         >>> get_offer_ids([], market_token)
         []
     """
+    offer_ids = []
     page = ""
-    product_list = []
     while True:
-        some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
-        page = some_prod.get("paging").get("nextPageToken")
+        # nextPageToken известен только после ответа на предыдущий запрос,
+        # поэтому страницы идут по очереди, но не блокируют цикл событий
+        page_ids, page = await asyncio.to_thread(
+            get_offer_page, page, campaign_id, market_token
+        )
+        offer_ids.extend(page_ids)
         if not page:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
     return offer_ids
 
 
@@ -138,104 +168,104 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Создать список остатков
 
     Args:
-        watch_remnants (list): список остатков 
+        watch_remnants (pd.DataFrame): таблица остатков
         offer_ids (list): список артикулов
         warehouse_id (str): идентификатор склада 
 
     Returns:
-        list: список остатков
+        tuple: все остатки и только ненулевые из них
     Examples:
         >>> create_stocks(watch_remnants, offer_ids, warehouse_id)
-        [{"offer_id": "123", "stock": 100}, {"offer_id": "456", "stock": 0}]
-        >>> create_stocks([], offer_ids, warehouse_id)
-        []
+        ([{"sku": "123", ...}, {"sku": "456", ...}], [{"sku": "123", ...}])
+        >>> create_stocks(pd.DataFrame(columns=["Код", "Количество"]), [], warehouse_id)
+        ([], [])
     """
     # Уберем то, что не загружено в market
-    stocks = list()
     date = str(datetime.datetime.utcnow().replace(
         microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
+    codes = watch_remnants["Код"].astype(str)
+    found = codes.isin(set(offer_ids)) & ~codes.duplicated()
+    found_codes = codes[found].tolist()
+    counts = watch_remnants.loc[found, "Количество"].astype(str)
+    counts = counts.replace({">10": "100", "1": "0"}).astype(int)
+    stocks = []
+    not_empty = []
+    for code, count in zip(found_codes, counts.tolist()):
+        stock = {
+            "sku": code,
+            "warehouseId": warehouse_id,
+            "items": [{"count": count, "type": "FIT", "updatedAt": date}],
+        }
+        stocks.append(stock)
+        if count != 0:
+            not_empty.append(stock)
+    # Добавим недостающее из загруженного:
+    missing = set(offer_ids).difference(found_codes)
+    for offer_id in offer_ids:
+        if offer_id in missing:
             stocks.append(
                 {
-                    "sku": str(watch.get("Код")),
+                    "sku": offer_id,
                     "warehouseId": warehouse_id,
                     "items": [
                         {
-                            "count": stock,
+                            "count": 0,
                             "type": "FIT",
                             "updatedAt": date,
                         }
                     ],
                 }
             )
-            offer_ids.remove(str(watch.get("Код")))
-    # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
-        )
-    return stocks
+            missing.discard(offer_id)
+    return stocks, not_empty
 
 
 def create_prices(watch_remnants, offer_ids):
     """Создать список цен
 
     Args:
-        watch_remnants (list): список остатков
-        offer_ids (str): список артикулов
+        watch_remnants (pd.DataFrame): таблица остатков
+        offer_ids (list): список артикулов
 
     Returns:
         list: список цен
     Examples:
         >>> create_prices(watch_remnants, offer_ids)
         [{"offer_id": "123", "price": 100}, {"offer_id": "456", "price": 0}]
-        >>> create_prices([], offer_ids)
+        >>> create_prices(watch_remnants, [])
         []
     """
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
-            }
-            prices.append(price)
+    codes = watch_remnants["Код"].astype(str)
+    found = codes.isin(set(offer_ids))
+    values = prices_conversion(watch_remnants.loc[found, "Цена"]).astype(int)
+    for code, value in zip(codes[found].tolist(), values.tolist()):
+        price = {
+            "id": code,
+            # "feed": {"id": 0},
+            "price": {
+                "value": value,
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+        prices.append(price)
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(
+    watch_remnants, campaign_id, market_token, offer_ids=None
+):
     """Загрузить цены
 
     Args:
-        watch_remnants (list): список остатков
+        watch_remnants (pd.DataFrame): таблица остатков
         campaign_id (str): идентификатор кампании
         market_token (str): токен продавца
+        offer_ids (list): список артикулов; если не передан, запрашивается у API
 
     Returns:
         list: список цен
@@ -246,36 +276,40 @@ async def upload_prices(watch_remnants, campaign_id, market_token):
         >>> upload_prices([], campaign_id, market_token)
         []
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if offer_ids is None:
+        offer_ids = await get_offer_ids(campaign_id, market_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    await send_batches(
+        update_price, divide(prices, 500), campaign_id, market_token
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    watch_remnants, campaign_id, market_token, warehouse_id, offer_ids=None
+):
     """Загрузить остатки
 
     Args:
-        watch_remnants (list): список остатков
+        watch_remnants (pd.DataFrame): таблица остатков
         campaign_id (str): идентификатор кампании
         market_token (str): токен продавца
         warehouse_id (str): идентификатор склада
+        offer_ids (list): список артикулов; если не передан, запрашивается у API
 
     Returns:
-        _type_: _description_
+        tuple: ненулевые остатки и все остатки
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
-    stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
+    if offer_ids is None:
+        offer_ids = await get_offer_ids(campaign_id, market_token)
+    stocks, not_empty = create_stocks(watch_remnants, offer_ids, warehouse_id)
+    await send_batches(
+        update_stocks, divide(stocks, 2000), campaign_id, market_token
     )
     return not_empty, stocks
 
 
-def main():
+async def main():
     """
     Главная функция 
     """
@@ -287,25 +321,36 @@ def main():
     warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID")
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
 
-    watch_remnants = download_stock()
     try:
-        # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
+        # Остатки и списки товаров обеих кампаний скачиваем одновременно
+        watch_remnants, fbs_offer_ids, dbs_offer_ids = await asyncio.gather(
+            asyncio.to_thread(download_stock),
+            get_offer_ids(campaign_fbs_id, market_token),
+            get_offer_ids(campaign_dbs_id, market_token),
+        )
+        # Обновить остатки и цены FBS
+        await upload_stocks(
+            watch_remnants,
+            campaign_fbs_id,
+            market_token,
+            warehouse_fbs_id,
+            fbs_offer_ids,
+        )
+        await upload_prices(
+            watch_remnants, campaign_fbs_id, market_token, fbs_offer_ids
+        )
+
+        # Обновить остатки и цены DBS
+        await upload_stocks(
+            watch_remnants,
+            campaign_dbs_id,
+            market_token,
+            warehouse_dbs_id,
+            dbs_offer_ids,
+        )
+        await upload_prices(
+            watch_remnants, campaign_dbs_id, market_token, dbs_offer_ids
+        )
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
@@ -315,4 +360,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
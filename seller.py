@@ -1,15 +1,50 @@
+import asyncio
+import gzip
 import io
 import logging.config
-import os
 import re
 import zipfile
 from environs import Env
 
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 logger = logging.getLogger(__file__)
 
+_NON_DIGIT = re.compile("[^0-9]")
+# Сжатие тел запросов включается явно (GZIP_UPLOADS=true), пока API
+# не подтвердили приём Content-Encoding: gzip
+GZIP_UPLOADS = Env().bool("GZIP_UPLOADS", False)
+# Тела меньше этого размера сжимать невыгодно
+GZIP_MIN_SIZE = 16 * 1024
+
+# Не больше стольких одновременных запросов и открытых соединений к API
+MAX_CONNECTIONS = 8
+
+# Общая сессия: соединения с API переиспользуются между запросами.
+# Лишние запросы ждут свободное соединение, а не открывают новое
+SESSION = requests.Session()
+SESSION.headers.update({"Accept": "application/json"})
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=MAX_CONNECTIONS,
+    pool_block=True,
+    # Обновления цен и остатков передают абсолютные значения, поэтому
+    # повторять можно и POST/PUT
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "POST", "PUT"]),
+        respect_retry_after_header=True,
+    ),
+)
+SESSION.mount("https://api-seller.ozon.ru", _adapter)
+SESSION.mount("https://api.partner.market.yandex.ru", _adapter)
+
 
 def get_product_list(last_id, client_id, seller_token):
     """Получить список товаров
@@ -32,6 +67,7 @@ def get_product_list(last_id, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {
         "filter": {
@@ -40,13 +76,36 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = SESSION.post(url, data=orjson.dumps(payload), headers=headers)
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object.get("result")
 
 
-def get_offer_ids(client_id, seller_token):
+def get_offer_page(last_id, client_id, seller_token):
+    """Получить идентификаторы товаров одной страницы
+
+    Из ответа сразу оставляем только артикулы, чтобы страница целиком
+    не хранилась дольше, чем нужно.
+
+    Args:
+        last_id (str): идентификатор последнего товара предыдущей страницы
+        client_id (str): идентификатор клиента
+        seller_token (str): токен продавца
+
+    Returns:
+        tuple: артикулы страницы, last_id следующей страницы и total
+    Example:
+        >>> get_offer_page('', '456', '434')
+        (['123', '456'], 'WzEyM10=', 2)
+    """
+
+    some_prod = get_product_list(last_id, client_id, seller_token)
+    page_ids = [product["offer_id"] for product in some_prod["items"]]
+    return page_ids, some_prod.get("last_id"), some_prod.get("total")
+
+
+async def get_offer_ids(client_id, seller_token):
     """Получить идентификаторы товаров
 
     Args:
@@ -56,26 +115,47 @@ def get_offer_ids(client_id, seller_token):
     Returns:
         list: список идентификаторов
     Example:
-        >>> get_offer_ids('456', '434')
+        >>> asyncio.run(get_offer_ids('456', '434'))
         ['123', '456']
 
     """
 
+    offer_ids = []
     last_id = ""
-    product_list = []
     while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
-        total = some_prod.get("total")
-        last_id = some_prod.get("last_id")
-        if total == len(product_list):
+        # Страницы связаны через last_id, поэтому запрашиваем их по очереди,
+        # но в отдельном потоке, чтобы не блокировать цикл событий
+        page_ids, last_id, total = await asyncio.to_thread(
+            get_offer_page, last_id, client_id, seller_token
+        )
+        offer_ids.extend(page_ids)
+        if not page_ids or len(offer_ids) >= total:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
     return offer_ids
 
 
+def compress_payload(payload):
+    """Подготовить тело запроса
+
+    Если включено GZIP_UPLOADS, большие тела сжимаются gzip,
+    остальные отправляются как есть.
+
+    Args:
+        payload (dict): тело запроса
+
+    Returns:
+        tuple: тело запроса в байтах и дополнительные заголовки
+    Example:
+        >>> compress_payload({"prices": []})
+        (b'{"prices":[]}', {})
+    """
+
+    body = orjson.dumps(payload)
+    if not GZIP_UPLOADS or len(body) < GZIP_MIN_SIZE:
+        return body, {}
+    return gzip.compress(body, compresslevel=1), {"Content-Encoding": "gzip"}
+
+
 def update_price(prices: list, client_id, seller_token):
     """Обновить цены
 
@@ -96,11 +176,14 @@ def update_price(prices: list, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
+    body, body_headers = compress_payload(payload)
+    headers.update(body_headers)
+    response = SESSION.post(url, data=body, headers=headers)
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
 
 
 def update_stocks(stocks: list, client_id, seller_token):
@@ -125,41 +208,42 @@ def update_stocks(stocks: list, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
+    body, body_headers = compress_payload(payload)
+    headers.update(body_headers)
+    response = SESSION.post(url, data=body, headers=headers)
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
 
 
 def download_stock():
     """Скачать остатки с сайта
 
     Returns:
-        list: список остатков
+        pd.DataFrame: таблица остатков
     example:
         >>> download_stock()
-        [{"offer_id": "123", "stock": 100}, {"offer_id": "456", "stock": 0}]
-        >>> download_stock()
-        []
+                Код Количество          Цена
+        0     123        >10  5'990.00 руб.
+        1     456          1  4'990.00 руб.
     """
 
     # Скачать остатки с сайта
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
+    response = SESSION.get(casio_url)
     response.raise_for_status()
+    # Создаем таблицу остатков часов прямо из архива в памяти:
     with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
+        with archive.open("ostatki.xls") as excel_file:
+            watch_remnants = pd.read_excel(
+                io=excel_file,
+                na_values=None,
+                keep_default_na=False,
+                header=17,
+                usecols=["Код", "Количество", "Цена"],
+            )
     return watch_remnants
 
 
@@ -167,42 +251,46 @@ def create_stocks(watch_remnants, offer_ids):
     """Создать список остатков
 
     Args:
-        watch_remnants (list): список остатков
+        watch_remnants (pd.DataFrame): таблица остатков
         offer_ids (list): список артикулов
 
     Returns:
-        list: список остатков
+        tuple: все остатки и только ненулевые из них
     example:
         >>> create_stocks(watch_remnants, offer_ids)
-        [{"offer_id": "123", "stock": 100}, {"offer_id": "456", "stock": 0}]
-        >>> create_stocks([], [])
-        []
+        ([{"offer_id": "123", "stock": 100}, {"offer_id": "456", "stock": 0}],
+         [{"offer_id": "123", "stock": 100}])
+        >>> create_stocks(pd.DataFrame(columns=["Код", "Количество"]), [])
+        ([], [])
     """
 
     # Уберем то, что не загружено в seller
+    codes = watch_remnants["Код"].astype(str)
+    found = codes.isin(set(offer_ids)) & ~codes.duplicated()
+    found_codes = codes[found].tolist()
+    counts = watch_remnants.loc[found, "Количество"].astype(str)
+    counts = counts.replace({">10": "100", "1": "0"}).astype(int)
     stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
+    not_empty = []
+    for code, count in zip(found_codes, counts.tolist()):
+        stock = {"offer_id": code, "stock": count}
+        stocks.append(stock)
+        if count != 0:
+            not_empty.append(stock)
+    missing = set(offer_ids).difference(found_codes)
     # Добавим недостающее из загруженного:
     for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
-    return stocks
+        if offer_id in missing:
+            stocks.append({"offer_id": offer_id, "stock": 0})
+            missing.discard(offer_id)
+    return stocks, not_empty
 
 
 def create_prices(watch_remnants, offer_ids):
     """Создать список цен
 
     Args:
-        watch_remnants (list): список остатков 
+        watch_remnants (pd.DataFrame): таблица остатков
         offer_ids (list): список артикулов
 
     Returns:
@@ -210,26 +298,24 @@ def create_prices(watch_remnants, offer_ids):
     Examples:
         >>> create_prices(watch_remnants, offer_ids)
         [100,200,300,...]
-        >>> create_prices([], [])
-        []  
         >>> create_prices(watch_remnants, [])
         []
-        >>> create_prices([], offer_ids)
-        []  
 
     """
 
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
+    codes = watch_remnants["Код"].astype(str)
+    found = codes.isin(set(offer_ids))
+    converted = prices_conversion(watch_remnants.loc[found, "Цена"])
+    prices = [
+        {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": code,
+            "old_price": "0",
+            "price": price,
+        }
+        for code, price in zip(codes[found].tolist(), converted.tolist())
+    ]
     return prices
 
 
@@ -254,7 +340,27 @@ def price_conversion(price: str) -> str:
         ''
      """
 
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    return _NON_DIGIT.sub("", price.split(".", 1)[0])
+
+
+def prices_conversion(prices: pd.Series) -> pd.Series:
+    """Преобразовать столбец цен так же, как price_conversion
+
+    Args:
+        prices: столбец цен, например ["5'990.00 руб.", "4,999.50"]
+    Returns:
+        столбец строк, например ["5990", "4999"]
+    Examples:
+        >>> prices_conversion(pd.Series(["5'990.00 руб.", "abc"])).tolist()
+        ['5990', '']
+    """
+
+    return (
+        prices.astype(str)
+        .str.split(".", n=1)
+        .str[0]
+        .str.replace(_NON_DIGIT, "", regex=True)
+    )
 
 
 def divide(lst: list, n: int):
@@ -279,13 +385,47 @@ def divide(lst: list, n: int):
         yield lst[i: i + n]
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+async def send_batches(update, batches, *args, limit=MAX_CONNECTIONS):
+    """Отправить партии параллельно
+
+    Args:
+        update (callable): функция отправки одной партии
+        batches (iterable): партии, например генератор divide()
+        *args: остальные аргументы функции отправки
+        limit (int): максимальное число одновременных запросов
+
+    Returns:
+        list: ответы API в порядке партий
+    Examples:
+        >>> asyncio.run(send_batches(update_price, [prices], client_id, seller_token))
+        [{"result": [...]}]
+        >>> asyncio.run(send_batches(update_price, [], client_id, seller_token))
+        []
+    """
+
+    # Партии берутся из общего итератора по мере освобождения отправителей,
+    # поэтому генератор divide() не разворачивается целиком заранее
+    batches = enumerate(batches)
+    responses = {}
+
+    async def sender():
+        for index, batch in batches:
+            responses[index] = await asyncio.to_thread(update, batch, *args)
+
+    await asyncio.gather(*(sender() for _ in range(limit)))
+    return [responses[index] for index in sorted(responses)]
+
+
+async def upload_prices(
+    watch_remnants, client_id, seller_token, offer_ids=None
+):
     """Загрузить цены 
 
     Args:
-        watch_remnants (list): список остатков
+        watch_remnants (pd.DataFrame): таблица остатков
         client_id (str): идентификатор клиента
         seller_token (str): токен продавца
+        offer_ids (list): список артикулов; если не передан, запрашивается у API
 
     Returns:
         list: список цен
@@ -296,54 +436,58 @@ async def upload_prices(watch_remnants, client_id, seller_token):
         []
     """
 
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await get_offer_ids(client_id, seller_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await send_batches(
+        update_price, divide(prices, 1000), client_id, seller_token
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(
+    watch_remnants, client_id, seller_token, offer_ids=None
+):
     """Загрузить остатки
 
     Args:
-        watch_remnants (list): список остаков товаров
+        watch_remnants (pd.DataFrame): таблица остатков товаров
         client_id (str): идентификатор клиента
         seller_token (str): токен продавца
+        offer_ids (list): список артикулов; если не передан, запрашивается у API
 
     Returns:
-        list: список остатков
+        tuple: ненулевые остатки и все остатки
     Examples:
-        >>> upload_stocks(watch_remnants, client_id, seller_token)
-        [{"offer_id": "123", "stock": 100}, {"offer_id": "456", "stock": 0}]
-        >>> upload_stocks([], client_id, seller_token)
-        []  
+        >>> asyncio.run(upload_stocks(watch_remnants, client_id, seller_token))
+        ([{"offer_id": "123", "stock": 100}],
+         [{"offer_id": "123", "stock": 100}, {"offer_id": "456", "stock": 0}])
 
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
-    stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    if offer_ids is None:
+        offer_ids = await get_offer_ids(client_id, seller_token)
+    stocks, not_empty = create_stocks(watch_remnants, offer_ids)
+    await send_batches(
+        update_stocks, divide(stocks, 100), client_id, seller_token
+    )
     return not_empty, stocks
 
 
-def main():
+async def main():
     """Главная функция"""
     env = Env()
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
-        watch_remnants = download_stock()
+        # Список товаров и остатки скачиваем одновременно
+        offer_ids, watch_remnants = await asyncio.gather(
+            get_offer_ids(client_id, seller_token),
+            asyncio.to_thread(download_stock),
+        )
         # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
+        await upload_stocks(watch_remnants, client_id, seller_token, offer_ids)
         # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
+        await upload_prices(watch_remnants, client_id, seller_token, offer_ids)
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
@@ -353,4 +497,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())